@@ -7,18 +7,42 @@ The epochs are constructed by using the events created in script 03. MNE
 supports hierarchical events that allows selection to different groups more
 easily. Some channels were not properly defined during acquisition, so they
 are redefined before epoching. Bad EEG channels are interpolated and epochs
-containing blinks are rejected. Finally
-the epochs are saved to disk. To save space, the epoch data can be decimated.
+containing blinks are rejected. The raw data are read lazily so that only the
+epoched segments are loaded in memory. Finally the epochs are saved to disk.
+To save space, the epoch data can be decimated.
 """
 
+import os
 import os.path as op
 import mne
 from mne.parallel import parallel_func
 
+try:
+    from joblib import parallel_backend
+except ImportError:  # without joblib, mne.parallel runs the subjects in turn
+    parallel_backend = None
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:  # threadpoolctl is installed with recent scikit-learn
+    threadpool_limits = None
+
 import config
 
+# The channels kept in the epochs. The stimulus channels are not needed as the
+# events are already stored in the epochs, while the EOG channels are needed
+# for the rejection.
+epochs_picks = dict(meg=True, eeg=True, eog=True, stim=False)
+
 
-N_JOBS = max(config.N_JOBS // 4, 1)  # make less parallel runs to limit memory usage
+def _prefetch(fname):
+    """Ask the OS to start reading a file into the page cache."""
+    if not hasattr(os, 'posix_fadvise'):  # not available on all platforms
+        return
+    fd = os.open(fname, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
 
 
 ###############################################################################
@@ -28,46 +52,100 @@ def run_epochs(subject):
 
     meg_subject_dir = op.join(config.meg_dir, subject)
 
-    raw_fnames_in = [op.join(meg_subject_dir, '%s_audvis_filt_sss_raw.fif' % subject)]
-    eve_fnames_in = [op.join(meg_subject_dir, '%s_audvis_filt-eve.fif' % subject)]
-
-    raw_list = list()
-    events_list = list()
-    print("  Loading raw data")
-    for raw_fname, eve_fname in zip(raw_fnames_in, eve_fnames_in):
-        raw = mne.io.read_raw_fif(raw_fname, preload=True)
-
-        events = mne.read_events(eve_fname)
-        events_list.append(events)
+    fname_stem = op.join(meg_subject_dir, '%s_audvis_filt' % subject)
+    raw_fnames_in = [fname_stem + '_sss_raw.fif']
+    eve_fnames_in = [fname_stem + '-eve.fif']
+    epochs_fname_out = op.join(meg_subject_dir, '%s-epo.fif' % subject)
+
+    events_list = [mne.read_events(eve_fname) for eve_fname in eve_fnames_in]
+
+    # Each run is epoched separately and the epochs are concatenated, so the
+    # concatenated continuous data are never materialized.
+    epochs_list = list()
+    for raw_fname, events in zip(raw_fnames_in, events_list):
+        print("  Loading %s" % op.basename(raw_fname))
+        # Only the run about to be epoched is prefetched, so the page cache
+        # is not filled with runs that are not needed yet
+        _prefetch(raw_fname)
+        # The raw data are not preloaded: only the samples falling in the
+        # epoch windows are read from disk when the epochs are constructed.
+        raw = mne.io.read_raw_fif(raw_fname, preload=False)
 
         raw.info['bads'] = config.bads[subject]
-        raw.interpolate_bads()
-        raw_list.append(raw)
-
-    raw, events = mne.concatenate_raws(raw_list, events_list=events_list)
-    raw.set_eeg_reference(projection=True)
-    del raw_list
-
-    picks = mne.pick_types(raw.info, meg=True, eeg=True, stim=True,
-                           eog=True, exclude=())
-
-    # Construct metadata from the epochs
-    # Add here if you need to attach a pandas dataframe as metadata
-    # to your epochs object.
 
-    # Epoch the data
-    print('  Epoching')
-    epochs = mne.Epochs(raw, events, config.event_id, config.tmin, config.tmax,
-                        proj=True, picks=picks, baseline=config.baseline, preload=False,
-                        decim=config.decim, reject=config.reject)
+        # Picking only drops the channels we do not keep (the stimulus
+        # channels), so that they are never read from disk
+        raw.pick(mne.pick_types(raw.info, exclude=(), **epochs_picks))
+
+        # Construct metadata from the epochs
+        # Add here if you need to attach a pandas dataframe as metadata
+        # to your epochs object.
+
+        # Rather than resampling the continuous data, we decimate the epochs
+        # so that only the retained samples are ever computed. Decimation
+        # does not filter the data, so with resample_sfreq we make sure the
+        # lowpass (see h_freq in script 01) is low enough for the new
+        # sampling frequency, using the same criterion as MNE.
+        sfreq = raw.info['sfreq']
+        decim = config.decim
+        if config.resample_sfreq is not None:
+            decim = max(int(round(sfreq / config.resample_sfreq)), 1)
+            new_sfreq = sfreq / decim
+            error = abs(new_sfreq - config.resample_sfreq)
+            if error > 0.01 * config.resample_sfreq:
+                raise ValueError('Cannot resample from %0.1f Hz to %0.1f Hz '
+                                 'by decimation, resample_sfreq must be '
+                                 'close to the sampling frequency divided '
+                                 'by an integer' % (sfreq,
+                                                    config.resample_sfreq))
+            if new_sfreq < 3 * raw.info['lowpass']:
+                raise ValueError('The data are lowpass filtered at %0.1f Hz, '
+                                 'decimating to %0.1f Hz requires a lowpass '
+                                 'of at most %0.1f Hz. Set h_freq '
+                                 'accordingly.' % (raw.info['lowpass'],
+                                                   new_sfreq, new_sfreq / 3.))
+            print('  Decimating by %d (%0.1f Hz -> %0.1f Hz)'
+                  % (decim, sfreq, new_sfreq))
+
+        # Epoch the data
+        print('  Epoching')
+        epochs = mne.Epochs(raw, events, config.event_id, config.tmin,
+                            config.tmax, proj=False, baseline=config.baseline,
+                            preload=True, decim=decim, reject=None)
+
+        # Bad channels are interpolated on the epoched data, which avoids
+        # loading the full continuous recordings in memory. The average
+        # reference is only added afterwards so that it includes the
+        # interpolated EEG channels.
+        epochs.interpolate_bads()
+        epochs.set_eeg_reference('average', projection=True)
+        epochs.apply_proj()
+        epochs_list.append(epochs)
+
+    epochs = mne.concatenate_epochs(epochs_list)
+    del epochs_list
+    # The rejection is done once on all the preloaded epochs
+    epochs.drop_bad(reject=config.reject)
 
     print('  Writing to disk')
-    epochs.save(op.join(meg_subject_dir, '%s-epo.fif' % subject))
+    epochs.save(epochs_fname_out, fmt=config.epochs_fmt, overwrite=True)
 
 
 ###############################################################################
 # Let us make the script parallel across subjects
 
-# Here we use fewer N_JOBS to prevent potential memory problems
-parallel, run_func, _ = parallel_func(run_epochs, n_jobs=N_JOBS)
-parallel(run_func(subject) for subject in config.subjects_list)
+# Here we use threads rather than processes: the heavy lifting (reading,
+# interpolating, projecting) is done in NumPy and releases the GIL, and the
+# workers do not need to duplicate the data in memory. The cores are split
+# between the threads so the BLAS libraries do not oversubscribe the CPUs.
+if parallel_backend is None:
+    parallel, run_func, _ = parallel_func(run_epochs, n_jobs=config.N_JOBS)
+    parallel(run_func(subject) for subject in config.subjects_list)
+else:
+    if threadpool_limits is not None and config.N_JOBS > 1:
+        threadpool_limits(max((os.cpu_count() or 1) // config.N_JOBS, 1),
+                          user_api='blas')
+    with parallel_backend('threading'):
+        parallel, run_func, _ = parallel_func(run_epochs,
+                                              n_jobs=config.N_JOBS)
+        parallel(run_func(subject) for subject in config.subjects_list)
@@ -6,6 +6,7 @@
 Calculate forward solution for MEG channels.
 """
 
+import os
 import os.path as op
 import mne
 
@@ -14,6 +15,16 @@ from mne.parallel import parallel_func
 import config
 
 
+def _is_up_to_date(fname_out, fnames_in):
+    """Check whether a file exists and is newer than all its inputs."""
+    try:
+        mtime_out = os.stat(fname_out).st_mtime
+        mtime_in = max(os.stat(fname).st_mtime for fname in fnames_in)
+    except OSError:  # one of the files does not exist
+        return False
+    return mtime_out > mtime_in
+
+
 def run_forward(subject):
     print("processing subject: %s" % subject)
     meg_subject_dir = op.join(config.meg_dir, subject)
@@ -21,22 +32,44 @@ def run_forward(subject):
     fname_fwd = op.join(meg_subject_dir,
                         '%s-%s-fwd.fif' % (subject, config.spacing))
     fname_trans = op.join(meg_subject_dir, '%s_audvis_raw-trans.fif' % subject)
-    src = mne.setup_source_space(subject, spacing=config.spacing,
-                                 subjects_dir=config.subjects_dir,
-                                 add_dist=False)
+    fname_src = op.join(meg_subject_dir,
+                        '%s-%s-src.fif' % (subject, config.spacing))
+    fnames_surf = [op.join(config.subjects_dir, subject, 'surf',
+                           '%s.white' % hemi) for hemi in ('lh', 'rh')]
 
-    evoked = mne.read_evokeds(fname_ave, condition=0)
+    # Only the measurement info is needed, so the evoked data are not read
+    info = mne.io.read_info(fname_ave)
 
     # Here we only use 1-layer BEM because the 3-layer is unreliable
-    if 'eeg' in evoked:
+    if len(mne.pick_types(info, meg=False, eeg=True, exclude=[])) > 0:
         fname_bem = op.join(config.subjects_dir, subject, 'bem',
                             '%s-5120-5120-5120-bem-sol.fif' % subject)
     else:
         fname_bem = op.join(config.subjects_dir, subject, 'bem',
                             '%s-5120-bem-sol.fif' % subject)
 
+    # Skip the computation if the forward solution is newer than all its
+    # inputs. The surfaces are included as they determine the source space,
+    # and the config file and this script so that changing any parameter
+    # triggers a recomputation.
+    fnames_in = [fname_ave, fname_trans, fname_src, fname_bem,
+                 config.__file__, __file__] + fnames_surf
+    if _is_up_to_date(fname_fwd, fnames_in):
+        print("  Forward solution is up to date, skipping")
+        return
+
+    # The source space only depends on the white surfaces, so it is computed
+    # once and then read from disk, as long as it is newer than the surfaces
+    if _is_up_to_date(fname_src, fnames_surf):
+        src = mne.read_source_spaces(fname_src)
+    else:
+        src = mne.setup_source_space(subject, spacing=config.spacing,
+                                     subjects_dir=config.subjects_dir,
+                                     add_dist=False)
+        mne.write_source_spaces(fname_src, src, overwrite=True)
+
     # Because we use a 1-layer BEM, we do MEG only
-    fwd = mne.make_forward_solution(evoked.info, fname_trans, src, fname_bem,
+    fwd = mne.make_forward_solution(info, fname_trans, src, fname_bem,
                                     mindist=config.mindist)
     mne.write_forward_solution(fname_fwd, fwd, overwrite=True)
 
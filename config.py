@@ -118,12 +118,18 @@ mf_st_duration = None
 #
 # ``resample_sfreq``  : a float that specifies at which sampling frequency
 # the data should be resampled. If None then no resampling will be done.
+# The resampling is done by decimating the epochs by an integer factor, which
+# overrides ``decim``, so ``resample_sfreq`` must be close to the original
+# sampling frequency divided by an integer. Decimation does not filter the
+# data: the new sampling rate must be at least 3 times the lowpass frequency
+# (``h_freq``), otherwise an error is raised.
 resample_sfreq = None
 
 
 # ``decim`` : integer that says how much to decimate data at the epochs level.
 # It is typically an alternative to the `resample_sfreq` parameter that
 # can be used for resampling raw data. 1 means no decimation.
+# It is ignored if ``resample_sfreq`` is not None.
 decim = 1
 
 ###############################################################################
@@ -157,6 +163,11 @@ event_id = {'Auditory/Left': 1, 'Auditory/Right': 2,
             'Visual/Left': 3, 'Visual/Right': 4}
 conditions = ['Auditory', 'Visual', 'Right', 'Left']
 
+# ``epochs_fmt`` : the precision used to save the epochs, 'single' (the MNE
+# default) or 'double'. Use 'double' if you need to keep the data in double
+# precision on disk, at the cost of files twice as large.
+epochs_fmt = 'single'
+
 ###############################################################################
 # ICA parameters
 # --------------